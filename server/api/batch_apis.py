@@ -42,26 +42,30 @@ def validate_batch_metadata(func):
     return wrapper
 
 
-def handle_batch_processing(metadata_list, processor):
+def handle_batch_processing(metadata_list, processor, action):
     processed_metadata_list = []
 
-    for metadata in metadata_list:
-        video_id = metadata["VideoId"]
-        full_transcript = utils.get_transcript(video_id=video_id)
-        chunk_size = utils.set_chunk_size(size=7000)
+    chunk_size = utils.set_chunk_size(size=7000)
 
-        chunks, total_chunk_num = utils.split_transcript(full_transcript, chunk_size)
+    for index, metadata in enumerate(metadata_list):
+        video_id = metadata["VideoId"]
 
-        if total_chunk_num > 1:
-            for i, chunk in enumerate(chunks, start=1):
-                result = processor["chunk"](chunk, i, total_chunk_num)
-                metadata["Results"] = (metadata.get("Results") or "") + result
-        else:
-            metadata["Results"] = processor["func"](full_transcript)
+        # Prepare the next transcript while this video is being processed
+        if utils.PREFETCH_ENABLED and index + 1 < len(metadata_list):
+            utils.transcript_prefetcher.prefetch(metadata_list[index + 1]["VideoId"], chunk_size)
 
-        metadata["Processed"] = True
+        try:
+            utils.process_video(metadata, processor, action, chunk_size)
+        except utils.YouTubeError as e:
+            # Keep going with the rest of the batch and report the error on this row
+            print(f"Failed to get transcript for {video_id}: {e}")
+            metadata["Error"] = utils.describe_error(e)
         processed_metadata_list.append(metadata)
 
+    calls_avoided = sum(
+        m["Deduplication"]["CallsAvoided"] for m in processed_metadata_list if "Deduplication" in m
+    )
+    print(f"Duplicate chunk detection avoided {calls_avoided} LLM calls in this batch")
     return processed_metadata_list
 
 @batch.route("/get_metadata", methods=["POST"])
@@ -86,6 +90,7 @@ def get_metadata_batch_route():
     df = df.loc[:, ~df.columns.str.contains("^Unnamed")]
 
     res_array = []
+    prefetch = utils.PREFETCH_ENABLED and request.form.get("prefetch", "true") != "false"
 
     for index, link in enumerate(df["Link"]):
         res_dict = {
@@ -102,12 +107,20 @@ def get_metadata_batch_route():
         video_id = utils.get_video_id(link)
         youtube_link = f"https://www.youtube.com/watch?v={video_id}"
 
-        # Get the metadata of the YouTube video
-        info_dict = utils.get_metadata(youtube_link)
-
         # Fill in the dict
         res_dict["VideoId"] = str(video_id)
         res_dict["Link"] = str(youtube_link)
+
+        # Get the metadata of the YouTube video
+        try:
+            info_dict = utils.get_metadata(youtube_link)
+        except utils.YouTubeError as e:
+            # Report the error on this row instead of failing the whole batch
+            print(f"Failed to get metadata for {video_id}: {e}")
+            res_dict["Error"] = utils.describe_error(e)
+            res_array.append(res_dict)
+            continue
+
         res_dict["Title"] = str(info_dict.get("title"))
         res_dict["Description"] = str(info_dict.get("description"))
         res_dict["Uploader"] = str(info_dict.get("uploader"))
@@ -119,12 +132,17 @@ def get_metadata_batch_route():
         res_dict["UploadDate"] = formatted_date
         res_array.append(res_dict)
 
+        # Start preparing the first transcripts while the user picks an action
+        if prefetch and index < utils.PREFETCH_BUDGET:
+            utils.transcript_prefetcher.prefetch(str(video_id), utils.set_chunk_size(size=7000))
+
     print(res_array)
     return jsonify({"success": True, "metadata": res_array}), 200
 
 
 @batch.route("/<action>", methods=["POST"])
 @validate_batch_metadata
+@utils.llm_request(utils.PRIORITY_BATCH)  # Batch work yields to interactive requests
 def handle_batch_action(metadata_list, action):
     processors = {
         "summarise": {
@@ -142,7 +160,7 @@ def handle_batch_action(metadata_list, action):
 
     processed_metadata_list = []
 
-    processed_metadata = handle_batch_processing(metadata_list, processors[action])
+    processed_metadata = handle_batch_processing(metadata_list, processors[action], action)
     processed_metadata_list.append(processed_metadata)
 
     return jsonify({"success": True, "metadata": processed_metadata_list}), 200
@@ -162,32 +180,27 @@ def batch_download_route():
             400,
         )
 
-    rows = []
+    # Results file format, one of utils.EXPORT_FORMATS
+    fmt = request.args.get("format", "xlsx")
+    if fmt not in utils.EXPORT_FORMATS:
+        return jsonify({"success": False, "message": "Invalid export format"}), 400
 
     temp_dir = tempfile.mkdtemp()
     transcript_files = []
     name_counts = {}
 
-    # Iterate over each dictionary in the list and build rows for the Excel file.
-    for idx, record in enumerate(data, start=1):
-        # Start with S/N as the first column
-        row = {"S/N": idx}
-        row.update(
-            {
-                k.capitalize(): v
-                for k, v in record.items()
-                if k not in ["VideoId", "Processed"]
-            }
-        )
-        rows.append(row)
-
-        # Get transcript file
+    # Collect the transcript file of each video
+    for record in data:
         link = record.get("Link")
         video_id = record.get("VideoId")
         if not link or not video_id:
             continue  # Skip invalid entries
 
-        transcript_file = utils.get_transcript_file(link, video_id)
+        try:
+            transcript_file = utils.get_transcript_file(link, video_id)
+        except utils.YouTubeError as e:
+            print(f"Failed to get transcript for {video_id}: {e}")
+            continue  # Skip if transcript could not be generated
         if not transcript_file or not os.path.exists(transcript_file):
             continue  # Skip if transcript could not be generated or file not found
 
@@ -207,15 +220,8 @@ def batch_download_route():
         os.rename(transcript_file, dest_file_path)
         transcript_files.append(dest_file_path)
 
-    df = pd.DataFrame(rows)
-    df.rename(columns={"Uploaddate": "Upload Date"}, inplace=True)
-    correct_order = ["S/N", "Link", "Title", "Description", "Uploader", "Upload Date", "Results"]
-    df = df[correct_order]  # Reorder columns explicitly
-
-    # Generate Excel file in the temp directory
-    excel_path = os.path.join(temp_dir, "output.xlsx")
-    with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name="Results")
+    # Stream the results file in the temp directory
+    export_path = utils.write_export(data, temp_dir, fmt)
 
     # Create a ZIP file to bundle everything
     zip_file = tempfile.mktemp(suffix=".zip")
@@ -224,8 +230,8 @@ def batch_download_route():
             zipf.write(file_path, arcname=os.path.join("transcripts", os.path.basename(file_path)))
 
 
-        # Add Excel file
-        zipf.write(excel_path, arcname="output.xlsx")
+        # Add results file
+        zipf.write(export_path, arcname=os.path.basename(export_path))
 
     # Send ZIP file as response
     response = send_file(zip_file, as_attachment=True, download_name="output.zip")
@@ -270,7 +276,11 @@ def get_transcript_zip_route():
             link = link_match.group(1)
             video_id = utils.get_video_id(link)
 
-            transcript_file = utils.get_transcript_file(link, video_id)
+            try:
+                transcript_file = utils.get_transcript_file(link, video_id)
+            except utils.YouTubeError as e:
+                print(f"Failed to get transcript for {video_id}: {e}")
+                continue
             if not transcript_file or not os.path.exists(transcript_file):
                 # Skip if the transcript could not be generated or file not found
                 continue
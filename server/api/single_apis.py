@@ -6,7 +6,6 @@ from flask import Blueprint, jsonify, request, send_file
 from datetime import datetime
 import re
 import utils
-import pandas as pd
 import io
 
 single = Blueprint("single", __name__)
@@ -50,24 +49,6 @@ def validate_metadata(func):
     return wrapper
 
 
-def handle_processing(metadata, processor):
-    video_id = metadata["VideoId"]
-    full_transcript = utils.get_transcript(video_id=video_id)
-    chunk_size = utils.set_chunk_size(size=7000)
-
-    chunks, total_chunk_num = utils.split_transcript(full_transcript, chunk_size)
-
-    if total_chunk_num > 1:
-        for i, chunk in enumerate(chunks, start=1):
-            result = processor["chunk"](chunk, i, total_chunk_num)
-            metadata["Results"] = (metadata.get("Results") or "") + result
-    else:
-        metadata["Results"] = processor["func"](full_transcript)
-
-    metadata["Processed"] = True
-    return metadata
-
-
 @single.route("/get_metadata", methods=["POST"])
 def get_metadata_route():
     data = request.get_json()
@@ -90,9 +71,15 @@ def get_metadata_route():
 
     try:
         info_dict = utils.get_metadata(youtube_link)
+    except utils.YouTubeError as e:
+        return utils.youtube_error_response(e)
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+    # Start preparing the transcript while the user picks an action
+    if utils.PREFETCH_ENABLED and data.get("prefetch", True):
+        utils.transcript_prefetcher.prefetch(video_id, utils.set_chunk_size(size=7000))
+
     res_dict = [
         {
             "VideoId": video_id,
@@ -119,6 +106,7 @@ def get_metadata_route():
 
 @single.route("/<action>", methods=["POST"])
 @validate_metadata
+@utils.llm_request(utils.PRIORITY_INTERACTIVE)
 def handle_single_action(metadata_list, action):
     processors = {
         "summarise": {
@@ -132,9 +120,14 @@ def handle_single_action(metadata_list, action):
     }
 
     processed_metadata_list = []
-    for metadata in metadata_list:
-        processed_metadata = handle_processing(metadata, processors[action])
-        processed_metadata_list.append(processed_metadata)
+    try:
+        for metadata in metadata_list:
+            processed_metadata = utils.process_video(
+                metadata, processors[action], action, utils.set_chunk_size(size=7000)
+            )
+            processed_metadata_list.append(processed_metadata)
+    except utils.YouTubeError as e:
+        return utils.youtube_error_response(e)
 
     return jsonify({"success": True, "metadata": processed_metadata_list}), 200
 
@@ -145,30 +138,21 @@ def download_route():
     if not data or not isinstance(data, list):
         return jsonify({"success": False, "message": "Invalid metadata format"}), 400
 
-    transcript_file = utils.get_transcript_file(data[0]["Link"],data[0]["VideoId"])
+    # Results file format, one of utils.EXPORT_FORMATS
+    fmt = request.args.get("format", "xlsx")
+    if fmt not in utils.EXPORT_FORMATS:
+        return jsonify({"success": False, "message": "Invalid export format"}), 400
+
+    try:
+        transcript_file = utils.get_transcript_file(data[0]["Link"],data[0]["VideoId"])
+    except utils.YouTubeError as e:
+        return utils.youtube_error_response(e)
     if not transcript_file:
         return (
             jsonify({"success": False, "message": "Failed to generate transcript"}),
             500,
         )
 
-    rows = []
-    for metadata in data:
-        # Start with S/N as the first key
-        row = {"S/N": len(rows) + 1}
-        # Then add the other keys (excluding "VideoId" and "Processed")
-        row.update(
-            {
-                k.capitalize(): v
-                for k, v in metadata.items()
-                if k not in ["VideoId", "Processed"]
-            }
-        )
-        rows.append(row)
-
-    df = pd.DataFrame(rows)
-    df.rename(columns={"Uploaddate": "Upload Date"}, inplace=True)
-
     # Create a temporary directory to store files
     with tempfile.TemporaryDirectory() as temp_dir:
         # Move transcript file to temp directory
@@ -176,10 +160,8 @@ def download_route():
         transcript_path = os.path.join(temp_dir, transcript_filename)
         os.rename(transcript_file, transcript_path)
 
-        # Generate and save the Excel file in the temporary directory
-        excel_path = os.path.join(temp_dir, "output.xlsx")
-        with pd.ExcelWriter(excel_path, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="Results")
+        # Generate and save the results file in the temporary directory
+        utils.write_export(data, temp_dir, fmt)
 
         # Create a temporary ZIP file
         zip_file = tempfile.mktemp(suffix=".zip")
@@ -225,7 +207,10 @@ def get_transcript_file_route():
     video_id = utils.get_video_id(link)
 
     # Call the function to get transcript file 
-    transcript_file = utils.get_transcript_file(link,video_id)
+    try:
+        transcript_file = utils.get_transcript_file(link,video_id)
+    except utils.YouTubeError as e:
+        return utils.youtube_error_response(e)
     if not transcript_file:
         return (
             jsonify({"success": False, "message": "Failed to generate transcript"}),
@@ -1,14 +1,887 @@
+import csv
+import hashlib
 import json
 import os
+import random
+import sqlite3
 import time
-from flask import after_this_request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+from flask import after_this_request, jsonify, request
 from ollama import chat  # type: ignore
 from ollama import ChatResponse  # type: ignore
+from openpyxl import Workbook  # type: ignore, for streaming Excel export
 from youtube_transcript_api import YouTubeTranscriptApi  # type: ignore, for transcript extraction
 import re
+import threading
 import tiktoken
 import yt_dlp  # type: ignore, for metadata extraction
 
+# Adaptive concurrency settings for calls made to Ollama
+# Never dispatch more calls than Ollama runs in parallel, extra calls would queue
+# first-in-first-out inside Ollama where interactive calls cannot overtake batch ones
+LLM_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_NUM_PARALLEL", 4))
+LLM_INITIAL_CONCURRENCY = min(2, LLM_MAX_CONCURRENCY)
+LLM_MIN_CONCURRENCY = 1
+LLM_LATENCY_TOLERANCE = 1.5  # back off when latency per token exceeds this multiple of the best seen
+LLM_BASELINE_DRIFT = 1.01  # lets the best seen latency recover from a lucky outlier
+LLM_MAX_QUEUE = 16  # requests per priority class admitted at once before new ones are rejected
+
+# Scheduling settings, interactive calls are always served before batch calls
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+BATCH_MAX_WAIT = 300  # seconds a batch call can wait before it is promoted
+INTERACTIVE_RESERVED_SLOTS = 1  # slots kept free for interactive calls
+INTERACTIVE_RESERVE_WINDOW = 60  # seconds the reservation lasts after the last interactive call
+
+# Transcript preprocessing applied between transcript fetch and chunking
+PREPROCESS_OPTIONS = {
+    "strip_tags": True,  # Drop [Music], [Applause] and similar markers
+    "dedupe_overlaps": True,  # Drop words repeated by rolling auto-captions
+    "remove_fillers": True,  # Drop um, uh and similar filler words
+    "normalize_whitespace": True,  # Collapse newlines and repeated spaces
+}
+CAPTION_OVERLAP_WINDOW = 20  # max words compared between consecutive caption lines
+NON_SPEECH_PATTERN = re.compile(
+    r"\[[^\]]*\]|\((?:music|applause|laughter|laughs|inaudible|silence)\)|[♪♫]+",
+    re.IGNORECASE,
+)
+FILLER_PATTERN = re.compile(r"\b(?:u+m+|u+h+|e+r+m+|h+m+|a+h+)\b[,.]?", re.IGNORECASE)
+
+# Near-duplicate chunk detection, results are reused across videos and requests
+CHUNK_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chunk_index.db")
+CHUNK_DUPLICATE_DISTANCE = 3  # max differing SimHash bits for two chunks to count as duplicates
+CHUNK_SHINGLE_SIZE = 3  # words per shingle when fingerprinting a chunk
+CHUNK_INDEX_MAX_RESULTS = 5000  # stored chunk results, the oldest are evicted first
+CHUNK_INDEX_MAX_VIDEOS = 2000  # videos whose shingles are kept for boilerplate detection
+BOILERPLATE_REMOVAL = True  # Drop intros, sponsor reads and outros shared with other videos
+BOILERPLATE_SHINGLE_SIZE = 8  # words per shingle when looking for text shared between videos
+BOILERPLATE_SAMPLE = 4  # keep one in this many shingle hashes in the index
+BOILERPLATE_MIN_WORDS = 30  # shortest shared run of words removed as boilerplate
+BOILERPLATE_MIN_VIDEOS = 3  # other videos, from the same uploader when known, a run must appear in
+BOILERPLATE_MAX_SHARE = 0.25  # keep the original transcript if more than this share would be removed
+
+# Columns and file formats available when downloading results
+EXPORT_COLUMNS = ["S/N", "Link", "Title", "Description", "Uploader", "Upload Date", "Results", "Error"]
+EXPORT_FORMATS = ["xlsx", "csv", "jsonl"]
+
+# Speculative transcript prefetch started by the metadata routes
+PREFETCH_ENABLED = True
+PREFETCH_BUDGET = 32  # prepared transcripts kept in memory, oldest are evicted first
+PREFETCH_WORKERS = 2
+
+# Limits for requests made to YouTube through yt-dlp and YouTubeTranscriptApi
+YOUTUBE_RATE = 2  # requests per second
+YOUTUBE_BURST = 5
+YOUTUBE_PREFETCH_RESERVE = 2  # tokens prefetches leave for request-path calls, below YOUTUBE_BURST
+YOUTUBE_MAX_RETRIES = 4
+YOUTUBE_BACKOFF_BASE = 1  # seconds, doubled on every retry
+YOUTUBE_BACKOFF_MAX = 30
+YOUTUBE_FAILURE_THRESHOLD = 5  # consecutive failures before the circuit opens
+YOUTUBE_RESET_TIMEOUT = 60  # seconds the circuit stays open before a trial request
+
+# Model routing, per-chunk steps and short inputs go to a smaller, faster model
+LARGE_MODEL = "llama3"  # 8B
+SMALL_MODEL = "llama3.2"  # 3B
+MODEL_ROUTING = {
+    "summarise": {
+        "chunk": SMALL_MODEL,  # per-chunk map steps
+        "short": SMALL_MODEL,  # whole transcripts up to short_max_tokens
+        "long": LARGE_MODEL,  # longer whole transcripts, up to the chunk size
+        "short_max_tokens": 3000,
+    },
+    "generate_ideas": {
+        "chunk": SMALL_MODEL,
+        "short": SMALL_MODEL,
+        "long": LARGE_MODEL,
+        "short_max_tokens": 4000,  # must stay below the 7000 token chunk size
+    },
+}
+SPOT_CHECK_RATE = 0.05  # share of small model results passed to spot check hooks
+
+
+class LLMBusyError(Exception):
+    # Raised when Ollama is saturated and the request should be retried later
+    def __init__(self, retry_after):
+        super().__init__("The model server is busy, please retry later")
+        self.retry_after = retry_after
+
+
+class LLMScheduler:
+    # Limits in-flight LLM calls and adjusts the limit with AIMD:
+    # additive increase while latency per token stays near the best observed,
+    # multiplicative decrease on errors or once it climbs above that baseline,
+    # which is the first sign of calls queueing inside Ollama.
+    # Waiting calls are served by priority class, then round-robin between
+    # users so that a single large batch cannot hog the model server.
+    def __init__(
+        self,
+        initial=LLM_INITIAL_CONCURRENCY,
+        min_limit=LLM_MIN_CONCURRENCY,
+        max_limit=LLM_MAX_CONCURRENCY,
+        tolerance=LLM_LATENCY_TOLERANCE,
+        max_queue=LLM_MAX_QUEUE,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.admitted = {}  # priority -> requests currently admitted
+        self.waiters = []
+        self.last_served = {}  # user key -> dispatch counter
+        self.dispatch_count = 0
+        self.last_interactive = None
+        self.avg_latency = None
+        self.avg_token_latency = None
+        self.min_token_latency = None
+        self.lock = threading.Condition()
+
+    def retry_after(self, priority=PRIORITY_INTERACTIVE):
+        # Rough estimate of how long until a queued request would get a slot
+        with self.lock:
+            avg_latency = self.avg_latency or 10
+            queued = len([w for w in self.waiters if w["priority"] <= priority])
+            return max(1, int(avg_latency * (queued + 1) / max(1, int(self.limit))))
+
+    @contextmanager
+    def admission(self, priority=PRIORITY_INTERACTIVE):
+        # Admission control at request entry, calls made by an admitted
+        # request wait for a slot instead of being rejected halfway through
+        with self.lock:
+            if self.admitted.get(priority, 0) >= self.max_queue:
+                raise LLMBusyError(self.retry_after(priority))
+            self.admitted[priority] = self.admitted.get(priority, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.admitted[priority] -= 1
+
+    def _effective_priority(self, waiter, now):
+        # Promote batch calls that have waited too long to avoid starvation
+        if now - waiter["enqueued"] > BATCH_MAX_WAIT:
+            return PRIORITY_INTERACTIVE
+        return waiter["priority"]
+
+    def _batch_limit(self, now):
+        # Keep slots free for interactive calls while users are active
+        if (
+            self.last_interactive is not None
+            and now - self.last_interactive < INTERACTIVE_RESERVE_WINDOW
+        ):
+            # Can be zero when overloaded, batch calls then wait unless promoted by aging
+            return max(0, int(self.limit) - INTERACTIVE_RESERVED_SLOTS)
+        return int(self.limit)
+
+    def _dispatch(self):
+        # Grant free slots to the next waiters, must be called with the lock held
+        now = time.monotonic()
+        while self.waiters and self.in_flight < int(self.limit):
+            best_priority = min(self._effective_priority(w, now) for w in self.waiters)
+            if best_priority != PRIORITY_INTERACTIVE and self.in_flight >= self._batch_limit(now):
+                break
+
+            candidates = [
+                w for w in self.waiters
+                if self._effective_priority(w, now) == best_priority
+            ]
+            # Fair share: serve the user who was served least recently, oldest call first
+            waiter = min(
+                candidates,
+                key=lambda w: (self.last_served.get(w["key"], -1), w["enqueued"]),
+            )
+            self.waiters.remove(waiter)
+            self.dispatch_count += 1
+            self.last_served[waiter["key"]] = self.dispatch_count
+            self.in_flight += 1
+            waiter["granted"] = True
+
+        self.lock.notify_all()
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, key=None):
+        with self.lock:
+            if priority == PRIORITY_INTERACTIVE:
+                self.last_interactive = time.monotonic()
+
+            waiter = {
+                "priority": priority,
+                "key": key,
+                "enqueued": time.monotonic(),
+                "granted": False,
+            }
+            self.waiters.append(waiter)
+            self._dispatch()
+            while not waiter["granted"]:
+                # Wake up regularly so that aging and reservations are re-evaluated
+                self.lock.wait(timeout=1)
+                if not waiter["granted"]:
+                    self._dispatch()
+
+    def release(self, latency, success, tokens=0):
+        # success is None for calls that give no load signal
+        with self.lock:
+            self.in_flight -= 1
+            if success is None:
+                self._dispatch()
+                return
+            if not success:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._dispatch()
+                return
+
+            self.avg_latency = _ewma(self.avg_latency, latency)
+
+            # Compare latency per processed token so that long and short prompts are comparable
+            token_latency = latency / max(1, tokens)
+            self.avg_token_latency = _ewma(self.avg_token_latency, token_latency)
+            if self.min_token_latency is None:
+                self.min_token_latency = token_latency
+            else:
+                self.min_token_latency = min(token_latency, self.min_token_latency * LLM_BASELINE_DRIFT)
+
+            if self.avg_token_latency > self.tolerance * self.min_token_latency:
+                self.limit = max(self.min_limit, self.limit / 2)
+                # Start the next measurement from the baseline instead of the congested average
+                self.avg_token_latency = self.min_token_latency
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._dispatch()
+
+
+def _ewma(average, value, weight=0.2):
+    return value if average is None else (1 - weight) * average + weight * value
+
+
+llm_scheduler = LLMScheduler()
+_llm_context = threading.local()
+
+
+@contextmanager
+def llm_priority(priority, key=None):
+    # Tag every LLM call made by the current request with a priority class and user key
+    previous = getattr(_llm_context, "value", None)
+    _llm_context.value = (priority, key)
+    try:
+        yield
+    finally:
+        _llm_context.value = previous
+
+
+def llm_chat(model, messages):
+    # Send a chat request to Ollama through the scheduler
+    priority, key = getattr(_llm_context, "value", None) or (PRIORITY_INTERACTIVE, None)
+    llm_scheduler.acquire(priority, key)
+    start = time.monotonic()
+    success = False
+    tokens = 0
+    try:
+        response = chat(model=model, messages=messages)
+        success = True
+        tokens = (response.get("prompt_eval_count") or 0) + (response.get("eval_count") or 0)
+        return response
+    except Exception as e:
+        if _is_model_missing(e):
+            success = None  # Says nothing about load on the model server
+        raise
+    finally:
+        llm_scheduler.release(time.monotonic() - start, success, tokens)
+
+
+def llm_request(priority):
+    # Route decorator: admit the request and tag its LLM calls with a priority class
+    # and the user key, answering 429 when the model server is saturated
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with llm_scheduler.admission(priority):
+                    with llm_priority(priority, request.remote_addr):
+                        return func(*args, **kwargs)
+            except LLMBusyError as e:
+                return busy_response(e)
+
+        return wrapper
+
+    return decorator
+
+
+def run_llm_tasks(tasks):
+    # Run LLM tasks concurrently and return their results in order, the scheduler
+    # decides how many of them actually reach Ollama at the same time
+    context = getattr(_llm_context, "value", None) or (PRIORITY_INTERACTIVE, None)
+
+    def run(task):
+        with llm_priority(*context):
+            return task()
+
+    if len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=min(len(tasks), LLM_MAX_CONCURRENCY)) as executor:
+        return list(executor.map(run, tasks))
+
+
+def simhash(text):
+    # 64-bit SimHash fingerprint over word shingles, similar texts differ in few bits
+    words = [_normalise_word(w) for w in text.split()]
+    words = [w for w in words if w]
+    shingles = [
+        " ".join(words[i : i + CHUNK_SHINGLE_SIZE])
+        for i in range(max(1, len(words) - CHUNK_SHINGLE_SIZE + 1))
+    ]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+
+    fingerprint = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ChunkIndex:
+    # Local SQLite index of text seen in earlier videos: sampled shingle hashes used
+    # to find boilerplate, and chunk fingerprints with the LLM result produced for them
+    def __init__(self, path=CHUNK_INDEX_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.fingerprints = {}  # task -> list of (fingerprint, row id, video id)
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_results "
+                "(id INTEGER PRIMARY KEY, task TEXT, video_id TEXT, fingerprint TEXT, result TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS shingles (hash INTEGER, video_id TEXT)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS shingles_hash ON shingles (hash)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, uploader TEXT, added REAL)"
+            )
+            # Shingles of videos that were evicted or never registered can no longer match
+            self.conn.execute(
+                "DELETE FROM shingles WHERE video_id NOT IN (SELECT video_id FROM videos)"
+            )
+            self.conn.commit()
+            for row_id, task, video_id, fingerprint in self.conn.execute(
+                "SELECT id, task, video_id, fingerprint FROM chunk_results"
+            ):
+                self.fingerprints.setdefault(task, []).append(
+                    (int(fingerprint, 16), row_id, video_id)
+                )
+        return self.conn
+
+    def share_shingles(self, video_id, uploader, hashes):
+        # Store the shingle hashes of a video and return those already seen in at least
+        # BOILERPLATE_MIN_VIDEOS other videos, only counting the same uploader when known
+        hashes = list(hashes)
+        shared = set()
+        uploader_filter = "AND v.uploader = ?" if uploader else ""
+        with self.lock:
+            conn = self._connect()
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    "SELECT s.hash FROM shingles s JOIN videos v ON v.video_id = s.video_id "
+                    f"WHERE s.video_id != ? {uploader_filter} AND s.hash IN ({placeholders}) "
+                    "GROUP BY s.hash HAVING COUNT(DISTINCT s.video_id) >= ?",
+                    [video_id, *([uploader] if uploader else []), *batch, BOILERPLATE_MIN_VIDEOS],
+                )
+                shared.update(row[0] for row in rows)
+
+            conn.execute(
+                "INSERT OR REPLACE INTO videos (video_id, uploader, added) VALUES (?, ?, ?)",
+                (video_id, uploader or "", time.time()),
+            )
+            conn.execute("DELETE FROM shingles WHERE video_id = ?", (video_id,))
+            conn.executemany(
+                "INSERT INTO shingles (hash, video_id) VALUES (?, ?)",
+                [(h, video_id) for h in hashes],
+            )
+
+            # Forget the shingles of the oldest videos beyond the history bound
+            evicted = [
+                row[0] for row in conn.execute(
+                    "SELECT video_id FROM videos ORDER BY added DESC LIMIT -1 OFFSET ?",
+                    (CHUNK_INDEX_MAX_VIDEOS,),
+                )
+            ]
+            for evicted_id in evicted:
+                conn.execute("DELETE FROM shingles WHERE video_id = ?", (evicted_id,))
+                conn.execute("DELETE FROM videos WHERE video_id = ?", (evicted_id,))
+            conn.commit()
+        return shared
+
+    def lookup(self, task, fingerprint, video_id):
+        # Return the stored result of the nearest duplicate chunk from another video, if any
+        with self.lock:
+            self._connect()
+            candidates = list(self.fingerprints.get(task, []))
+
+        # Scan without holding the lock, the list is bounded by CHUNK_INDEX_MAX_RESULTS
+        best_distance, best_row_id = CHUNK_DUPLICATE_DISTANCE + 1, None
+        for stored, row_id, stored_video_id in candidates:
+            if stored_video_id == video_id:
+                continue  # Processing a video again should give a fresh result
+            distance = hamming_distance(stored, fingerprint)
+            if distance < best_distance:
+                best_distance, best_row_id = distance, row_id
+        if best_row_id is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM chunk_results WHERE id = ?", (best_row_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, task, fingerprint, result, video_id):
+        with self.lock:
+            conn = self._connect()
+            cursor = conn.execute(
+                "INSERT INTO chunk_results (task, video_id, fingerprint, result) VALUES (?, ?, ?, ?)",
+                (task, video_id, f"{fingerprint:016x}", result),
+            )
+            self.fingerprints.setdefault(task, []).append(
+                (fingerprint, cursor.lastrowid, video_id)
+            )
+
+            # Evict the oldest results beyond the size bound
+            row = conn.execute(
+                "SELECT MIN(id) FROM (SELECT id FROM chunk_results ORDER BY id DESC LIMIT ?)",
+                (CHUNK_INDEX_MAX_RESULTS,),
+            ).fetchone()
+            oldest_kept = row[0]
+            if oldest_kept is not None:
+                conn.execute("DELETE FROM chunk_results WHERE id < ?", (oldest_kept,))
+                for key, entries in self.fingerprints.items():
+                    self.fingerprints[key] = [e for e in entries if e[1] >= oldest_kept]
+            conn.commit()
+
+
+chunk_index = ChunkIndex()
+
+
+def shingle_hashes(words):
+    # Sampled (position, hash) pairs of the word shingles of a transcript
+    words = [_normalise_word(w) for w in words]
+    for i in range(len(words) - BOILERPLATE_SHINGLE_SIZE + 1):
+        shingle = " ".join(words[i : i + BOILERPLATE_SHINGLE_SIZE])
+        value = int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big", signed=True
+        )
+        if value % BOILERPLATE_SAMPLE == 0:
+            yield i, value
+
+
+def remove_boilerplate(video_id, uploader, text):
+    # Remove long runs of words that recur across other videos, such as repeated
+    # intros, sponsor reads and outros, and return the text with the number of words removed
+    words = text.split()
+    sampled = list(shingle_hashes(words))
+    shared = chunk_index.share_shingles(video_id, uploader, {value for _, value in sampled})
+
+    # Merge shared shingles into runs, sampling leaves gaps of a few words between them
+    runs = []
+    for position, value in sampled:
+        if value not in shared:
+            continue
+        end = position + BOILERPLATE_SHINGLE_SIZE
+        if runs and position <= runs[-1][1] + BOILERPLATE_SHINGLE_SIZE:
+            runs[-1][1] = max(runs[-1][1], end)
+        else:
+            runs.append([position, end])
+
+    removed = [False] * len(words)
+    for start, end in runs:
+        if end - start >= BOILERPLATE_MIN_WORDS:
+            for i in range(start, end):
+                removed[i] = True
+
+    kept = [word for word, drop in zip(words, removed) if not drop]
+
+    # Removing this much is more likely a re-upload or clip than boilerplate
+    if len(words) - len(kept) > BOILERPLATE_MAX_SHARE * len(words):
+        print(f"Keeping the full transcript of {video_id}, too much of it matched other videos")
+        return text, 0
+    return " ".join(kept), len(words) - len(kept)
+
+
+missing_models = set()  # routed models that turned out not to be installed in Ollama
+
+
+def select_model(action, step, tokens):
+    # Pick the model for a "chunk" or "full" step of an action
+    routing = MODEL_ROUTING.get(action, {})
+    if step == "chunk":
+        model = routing.get("chunk", LARGE_MODEL)
+    elif tokens <= routing.get("short_max_tokens", 0):
+        model = routing.get("short", LARGE_MODEL)
+    else:
+        model = routing.get("long", LARGE_MODEL)
+    return LARGE_MODEL if model in missing_models else model
+
+
+def _is_model_missing(error):
+    # Ollama answers 404 when the requested model has not been pulled
+    return getattr(error, "status_code", None) == 404
+
+
+spot_checks = []
+
+
+def register_spot_check(hook):
+    # hook(task, model, text, result) is called on a sample of small model results,
+    # returning False re-runs the step on the large model
+    spot_checks.append(hook)
+    return hook
+
+
+def spot_check(func, text, args, model, result, report):
+    # Pass a sample of small model results to the hooks, re-running on the large model if one fails
+    if model != LARGE_MODEL and spot_checks and random.random() < SPOT_CHECK_RATE:
+        for hook in spot_checks:
+            if hook(func.__name__, model, text, result) is False:
+                print(f"Spot check failed for {model}, escalating to {LARGE_MODEL}")
+                report["Calls"] += 1
+                return func(text, *args, model=LARGE_MODEL)
+    return result
+
+
+def routed_call(func, text, report, *args, model=LARGE_MODEL):
+    try:
+        result = func(text, *args, model=model)
+    except Exception as e:
+        if model == LARGE_MODEL or not _is_model_missing(e):
+            raise
+        # Fall back to the large model for installs without the smaller one
+        print(f"Model {model} is not installed, using {LARGE_MODEL} instead")
+        missing_models.add(model)
+        model = LARGE_MODEL
+        result = func(text, *args, model=model)
+    report["Calls"] += 1
+    return spot_check(func, text, args, model, result, report)
+
+
+def chunk_fingerprint(text, seen, report):
+    # Fingerprint a chunk, or return None when it is blank or duplicates
+    # a chunk already seen in this video and should be dropped
+    if not text.strip():
+        report["CallsAvoided"] += 1
+        return None
+
+    fingerprint = simhash(text)
+    if any(hamming_distance(fingerprint, other) <= CHUNK_DUPLICATE_DISTANCE for other in seen):
+        print("Dropping duplicate chunk")
+        report["CallsAvoided"] += 1
+        return None
+    seen.append(fingerprint)
+    return fingerprint
+
+
+def cached_call(func, text, fingerprint, report, *args, video_id=None, model=LARGE_MODEL):
+    # Call func on text unless it duplicates a chunk of another video (previous result reused).
+    # Without a video_id the result is neither looked up nor stored.
+    if video_id is None:
+        return routed_call(func, text, report, *args, model=model)
+
+    # Results are only reused for the model currently routed to this step
+    task = f"{func.__name__}:{model}"
+    result = chunk_index.lookup(task, fingerprint, video_id)
+    if result is not None:
+        print("Reusing result of a duplicate chunk")
+        report["CallsAvoided"] += 1
+        return spot_check(func, text, args, model, result, report)
+
+    # Spot checks run before storing so an escalated result is what gets reused
+    result = routed_call(func, text, report, *args, model=model)
+    chunk_index.add(task, fingerprint, result, video_id)
+    return result
+
+
+def export_rows(records):
+    # Yield one row per video in EXPORT_COLUMNS order
+    for idx, record in enumerate(records, start=1):
+        yield [
+            idx,
+            record.get("Link"),
+            record.get("Title"),
+            record.get("Description"),
+            record.get("Uploader"),
+            record.get("UploadDate"),
+            record.get("Results"),
+            (record.get("Error") or {}).get("Message"),
+        ]
+
+
+def write_export(records, output_dir, fmt="xlsx"):
+    # Write the results file row by row so memory stays flat for large batches
+    output_path = os.path.join(output_dir, f"output.{fmt}")
+
+    if fmt == "xlsx":
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("Results")
+        sheet.append(EXPORT_COLUMNS)
+        for row in export_rows(records):
+            sheet.append(row)
+        workbook.save(output_path)
+    elif fmt == "csv":
+        # utf-8-sig so that Excel detects the encoding
+        with open(output_path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(export_rows(records))
+    elif fmt == "jsonl":
+        with open(output_path, "w", encoding="utf-8") as f:
+            for row in export_rows(records):
+                f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+    else:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    return output_path
+
+
+def busy_response(error):
+    # Build a 429 response telling the client when to retry
+    response = jsonify({"success": False, "message": str(error)})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    response.headers["Access-Control-Expose-Headers"] = "Retry-After"
+    return response
+
+
+class YouTubeError(Exception):
+    # Base error for failed YouTube requests
+    status_code = 502
+
+
+class YouTubeRateLimitedError(YouTubeError):
+    # YouTube kept throttling the request after all retries
+    status_code = 429
+
+
+class YouTubeUnavailableError(YouTubeError):
+    # The circuit breaker is open, YouTube is failing so requests fail fast
+    status_code = 503
+
+
+class VideoUnavailableError(YouTubeError):
+    # The video or its transcript does not exist, retrying will not help
+    status_code = 404
+
+
+PERMANENT_YOUTUBE_ERRORS = [
+    "TranscriptsDisabled",
+    "NoTranscriptFound",
+    "NoTranscriptAvailable",
+    "VideoUnavailable",
+    "InvalidVideoId",
+    "AgeRestricted",
+    "VideoUnplayable",
+    "NotTranslatable",
+    "TranslationLanguageNotAvailable",
+    "CookiePathInvalid",
+    "CookiesInvalid",
+    "FailedToCreateConsentCookie",
+]
+PERMANENT_YOUTUBE_MESSAGES = [
+    "video unavailable",
+    "private video",
+    "sign in to confirm your age",
+    "age-restricted",
+    "members-only",
+    "join this channel",
+    "is not a valid url",
+    "unsupported url",
+    "incomplete youtube id",
+]
+# Errors worth retrying, anything else (such as a bug in our code) is raised as is
+RETRYABLE_YOUTUBE_ERRORS = [
+    "DownloadError",
+    "ExtractorError",
+    "CouldNotRetrieveTranscript",
+    "YouTubeRequestFailed",
+    "TooManyRequests",
+    "RequestBlocked",
+    "IpBlocked",
+]
+
+
+def describe_error(error):
+    # Typed error attached to a row of a batch
+    return {"Type": type(error).__name__, "Message": str(error)}
+
+
+def youtube_error_response(error):
+    return jsonify({"success": False, "message": str(error), "error": describe_error(error)}), error.status_code
+
+
+class TokenBucket:
+    # Shared rate limiter, every request to YouTube takes one token
+    def __init__(self, rate=YOUTUBE_RATE, burst=YOUTUBE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = 0  # request-path callers waiting for a token
+        self.lock = threading.Lock()
+
+    def acquire(self, background=False):
+        # Background callers only take tokens above the reserve, and never
+        # while a request-path caller is waiting
+        needed = 1 + YOUTUBE_PREFETCH_RESERVE if background else 1
+        queued = False
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    blocked = background and self.waiting > 0
+                    if now >= self.paused_until and self.tokens >= needed and not blocked:
+                        self.tokens -= 1
+                        return
+                    if not background and not queued:
+                        self.waiting += 1
+                        queued = True
+                    wait = max(self.paused_until - now, (needed - self.tokens) / self.rate)
+                    if blocked:
+                        wait = max(wait, 1 / self.rate)
+                time.sleep(wait)
+        finally:
+            if queued:
+                with self.lock:
+                    self.waiting -= 1
+
+    def pause(self, seconds):
+        # Hold back every caller after YouTube starts throttling
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+    # Fails fast after repeated failures and lets a trial request through after a timeout
+    def __init__(self, threshold=YOUTUBE_FAILURE_THRESHOLD, reset_timeout=YOUTUBE_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        # Return True when the caller is the single trial request of a half-open circuit
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise YouTubeUnavailableError("YouTube is currently unavailable, please retry later")
+            self.probing = True
+            return True
+
+    def end_probe(self):
+        # The trial request finished without a verdict, let the next caller try
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.probing = False
+                print("YouTube circuit breaker opened")
+
+
+youtube_rate_limiter = TokenBucket()
+youtube_context = threading.local()  # background is set on prefetch worker threads
+youtube_breaker = CircuitBreaker()
+
+
+def _is_rate_limited(error):
+    text = f"{type(error).__name__} {error}".lower()
+    return "429" in text or "too many requests" in text or "toomanyrequests" in text or "blocked" in text
+
+
+def _error_names(error):
+    return [cls.__name__ for cls in type(error).__mro__]
+
+
+def _is_permanent(error):
+    text = str(error).lower()
+    return any(name in PERMANENT_YOUTUBE_ERRORS for name in _error_names(error)) or any(
+        message in text for message in PERMANENT_YOUTUBE_MESSAGES
+    )
+
+
+def _is_retryable(error):
+    # Network errors (including those from requests) are OSErrors
+    return isinstance(error, OSError) or any(
+        name in RETRYABLE_YOUTUBE_ERRORS for name in _error_names(error)
+    )
+
+
+def youtube_call(func, *args, **kwargs):
+    # Call YouTube through the shared rate limiter and circuit breaker,
+    # retrying transient failures with jittered exponential backoff
+    probe = youtube_breaker.check()
+    try:
+        for attempt in range(YOUTUBE_MAX_RETRIES + 1):
+            youtube_rate_limiter.acquire(background=getattr(youtube_context, "background", False))
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if _is_permanent(e):
+                    youtube_breaker.record_success()  # YouTube answered, the video is the problem
+                    raise VideoUnavailableError(str(e)) from e
+                if not _is_retryable(e):
+                    raise
+
+                rate_limited = _is_rate_limited(e)
+                delay = random.uniform(0, min(YOUTUBE_BACKOFF_MAX, YOUTUBE_BACKOFF_BASE * 2**attempt))
+                if rate_limited:
+                    youtube_rate_limiter.pause(delay)
+
+                if attempt == YOUTUBE_MAX_RETRIES:
+                    if rate_limited:
+                        raise YouTubeRateLimitedError(str(e)) from e
+                    # One failure per call, so a single bad video cannot open the circuit
+                    youtube_breaker.record_failure()
+                    raise YouTubeError(str(e)) from e
+
+                print(f"YouTube request failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                youtube_breaker.record_success()
+                return result
+    finally:
+        if probe:
+            youtube_breaker.end_probe()
+
+
 def get_video_id(link):
     # Get the video ID from the link
     if type(link) == re.Match:
@@ -28,17 +901,94 @@ def get_metadata(link):
     }
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info_dict = ydl.extract_info(link, download=False)
+        info_dict = youtube_call(ydl.extract_info, link, download=False)
 
     return info_dict
 
 
-def get_transcript(video_id):
-    # Get the transcript of the YouTube video
-    transcript_list = YouTubeTranscriptApi.get_transcript(video_id)
-    full_transcript = " ".join([line["text"] for line in transcript_list])
+def strip_non_speech(text):
+    # Remove caption markers such as [Music], (Applause) and ♪ symbols
+    return NON_SPEECH_PATTERN.sub(" ", text)
+
+
+def remove_fillers(text):
+    # Remove filler words that add tokens but no meaning
+    return FILLER_PATTERN.sub(" ", text)
+
 
-    return full_transcript
+def merge_caption_lines(segments):
+    # Join caption segments, dropping words repeated by rolling auto-captions
+    # where a segment overlaps the previous one in time and starts with its tail end
+    words = []
+    previous_end = None
+    for segment in segments:
+        new_words = segment["text"].split()
+        if not new_words:
+            continue
+
+        start = segment.get("start", 0)
+        overlaps_previous = previous_end is not None and start < previous_end
+        previous_end = start + segment.get("duration", 0)
+
+        overlap = 0
+        max_overlap = min(len(words), len(new_words), CAPTION_OVERLAP_WINDOW)
+        if not overlaps_previous:
+            max_overlap = 0  # Separate speech in time, keep any repeated words
+        for size in range(max_overlap, 0, -1):
+            # A single repeated word is too likely to be genuine speech
+            if size < 2 and size < len(new_words):
+                break
+            tail = [_normalise_word(w) for w in words[-size:]]
+            head = [_normalise_word(w) for w in new_words[:size]]
+            if tail == head:
+                overlap = size
+                break
+
+        words.extend(new_words[overlap:])
+    return " ".join(words)
+
+
+def _normalise_word(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def preprocess_transcript(segments, options=None):
+    # Clean up raw caption segments before they are chunked and sent to the model
+    options = PREPROCESS_OPTIONS if options is None else options
+
+    segments = [dict(segment) for segment in segments]
+    for segment in segments:
+        if options.get("strip_tags"):
+            segment["text"] = strip_non_speech(segment["text"])
+        if options.get("remove_fillers"):
+            segment["text"] = remove_fillers(segment["text"])
+
+    if options.get("dedupe_overlaps"):
+        text = merge_caption_lines(segments)
+    else:
+        text = " ".join(segment["text"] for segment in segments)
+
+    if options.get("normalize_whitespace"):
+        text = " ".join(text.split())
+    return text
+
+
+def get_transcript(video_id, options=None):
+    # Get the transcript of the YouTube video and preprocess it
+    transcript_list = youtube_call(YouTubeTranscriptApi.get_transcript, video_id)
+    raw_transcript = " ".join([line["text"] for line in transcript_list])
+    full_transcript = preprocess_transcript(transcript_list, options)
+
+    raw_tokens = encode(raw_transcript)
+    tokens = encode(full_transcript) if full_transcript != raw_transcript else raw_tokens
+    stats = {
+        "RawTokens": raw_tokens,
+        "Tokens": tokens,
+        "TokensSaved": raw_tokens - tokens,
+    }
+    print(f"Preprocessing saved {raw_tokens - tokens} of {raw_tokens} tokens for {video_id}")
+
+    return full_transcript, stats
 
 def format_timestamp(seconds):
     # Convert seconds to [hh:mm:ss] format.
@@ -49,35 +999,31 @@ def format_timestamp(seconds):
     return f"[{minutes:02}:{seconds:02}]"
 
 def get_transcript_file(link, video_id, lang="en"):
-    try:
-        # Get video metadata
-        metadata = get_metadata(link)
-        title = metadata.get("title", "Unknown Video Title")
-        title = title.replace(" ", "_").replace("/", "_")  # Ensure a safe filename
-        
-        # Output file path
-        output_file = f"{title}.txt"
-
-        # Get the transcript of the YouTube video
-        transcript = YouTubeTranscriptApi.get_transcript(video_id, languages=[lang])
-
-        # Prepare output content
-        output = [f"Title: {title.replace('_', ' ')}\n"]
-        for entry in transcript:
-            timestamp = format_timestamp(entry['start'])
-            output.append(f"{timestamp} {entry['text']}.\n\n")
-
-        # Save to a text file
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write("".join(output))
-
-        # Return the transcript file path
-        print(f"Transcript saved to {output_file}")
-        return output_file
+    # Get video metadata
+    metadata = get_metadata(link)
+    title = metadata.get("title", "Unknown Video Title")
+    title = title.replace(" ", "_").replace("/", "_")  # Ensure a safe filename
+
+    # Output file path
+    output_file = f"{title}.txt"
+
+    # Get the transcript of the YouTube video
+    transcript = youtube_call(YouTubeTranscriptApi.get_transcript, video_id, languages=[lang])
+
+    # Prepare output content
+    output = [f"Title: {title.replace('_', ' ')}\n"]
+    for entry in transcript:
+        timestamp = format_timestamp(entry['start'])
+        output.append(f"{timestamp} {entry['text']}.\n\n")
+
+    # Save to a text file
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("".join(output))
+
+    # Return the transcript file path
+    print(f"Transcript saved to {output_file}")
+    return output_file
 
-    except Exception as e:
-        return f"Error: {e}"
-    
 def schedule_file_removal(response, transcript_file):
     # Schedule file deletion after the request is completed.
     @after_this_request
@@ -118,10 +1064,140 @@ def split_transcript(full_transcript, chunk_size):
         return [full_transcript], 1
 
 
-def provide_summary_chunk(chunk, chunk_num, total_chunk_num):
+def prepare_transcript(video_id, chunk_size):
+    # Fetch, preprocess and chunk a transcript so that inference can start right away
+    full_transcript, stats = get_transcript(video_id=video_id)
+    chunks, total_chunk_num = split_transcript(full_transcript, chunk_size)
+    return full_transcript, stats, chunks, total_chunk_num
+
+
+def prefetch_transcript(video_id, chunk_size):
+    # Prefetches run at background priority in the YouTube rate limiter
+    youtube_context.background = True
+    return prepare_transcript(video_id, chunk_size)
+
+
+class TranscriptPrefetcher:
+    # Prepares transcripts in the background after a metadata lookup,
+    # since the user nearly always summarises or generates ideas next
+    def __init__(self, budget=PREFETCH_BUDGET, workers=PREFETCH_WORKERS):
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.entries = OrderedDict()  # video id -> (chunk size, future)
+        self.lock = threading.Lock()
+
+    def prefetch(self, video_id, chunk_size):
+        with self.lock:
+            if video_id in self.entries:
+                self.entries.move_to_end(video_id)
+                return
+
+            future = self.executor.submit(prefetch_transcript, video_id, chunk_size)
+            self.entries[video_id] = (chunk_size, future)
+
+            # Evict the oldest entries over budget, cancelling them if not started yet
+            while len(self.entries) > self.budget:
+                evicted_id, (_, evicted) = self.entries.popitem(last=False)
+                evicted.cancel()
+                print(f"Evicted prefetched transcript for {evicted_id}")
+
+    def take(self, video_id, chunk_size):
+        # Return the prepared transcript, or None if it was not prefetched or failed
+        with self.lock:
+            entry = self.entries.pop(video_id, None)
+        if entry is None or entry[0] != chunk_size:
+            return None
+
+        # A prefetch still queued behind other work is cancelled and done inline,
+        # only one that is already running is worth waiting for
+        if entry[1].cancel() or entry[1].cancelled():
+            return None
+
+        try:
+            return entry[1].result()
+        except VideoUnavailableError:
+            raise  # Fetching again would fail the same way
+        except Exception as e:
+            print(f"Prefetch failed for {video_id}: {e}")
+            return None
+
+
+transcript_prefetcher = TranscriptPrefetcher()
+
+
+def get_prepared_transcript(video_id, chunk_size):
+    # Use the prefetched transcript when available, otherwise prepare it now
+    prepared = transcript_prefetcher.take(video_id, chunk_size)
+    if prepared is not None:
+        print(f"Using prefetched transcript for {video_id}")
+        return prepared
+    return prepare_transcript(video_id, chunk_size)
+
+
+def process_video(metadata, processor, action, chunk_size):
+    # Run a summarise or generate_ideas processor over the transcript of one video
+    video_id = metadata["VideoId"]
+    full_transcript, stats, chunks, total_chunk_num = get_prepared_transcript(
+        video_id, chunk_size
+    )
+    stats = dict(stats)
+    stats["TokensSent"] = stats["Tokens"]
+
+    # Boilerplate is looked up and recorded here rather than when prefetching,
+    # so that only videos which are actually processed change the index
+    if BOILERPLATE_REMOVAL:
+        full_transcript, removed = remove_boilerplate(
+            video_id, metadata.get("Uploader"), full_transcript
+        )
+        stats["BoilerplateWordsRemoved"] = removed
+        if removed:
+            stats["TokensSent"] = encode(full_transcript)
+            total_chunk_num_before = total_chunk_num
+            chunks, total_chunk_num = split_transcript(full_transcript, chunk_size)
+            stats["ChunksRemoved"] = max(0, total_chunk_num_before - total_chunk_num)
+
+    # Fingerprints of chunks already processed for this video
+    seen = []
+    report = {"Calls": 0, "CallsAvoided": stats.get("ChunksRemoved", 0)}
+
+    if total_chunk_num > 1:
+        model = select_model(action, "chunk", stats["TokensSent"])
+        tasks = []
+        chunk_reports = []
+        for i, chunk in enumerate(chunks, start=1):
+            fingerprint = chunk_fingerprint(chunk, seen, report)
+            if fingerprint is None:
+                continue
+            # Each chunk counts its calls separately as the chunks run concurrently
+            chunk_report = {"Calls": 0, "CallsAvoided": 0}
+            chunk_reports.append(chunk_report)
+            tasks.append(partial(
+                cached_call, processor["chunk"], chunk, fingerprint, chunk_report, i, total_chunk_num,
+                video_id=video_id, model=model,
+            ))
+
+        results = run_llm_tasks(tasks)
+        for chunk_report in chunk_reports:
+            report["Calls"] += chunk_report["Calls"]
+            report["CallsAvoided"] += chunk_report["CallsAvoided"]
+        metadata["Results"] = (metadata.get("Results") or "") + "".join(results)
+    else:
+        model = select_model(action, "full", stats["TokensSent"])
+        fingerprint = chunk_fingerprint(full_transcript, seen, report)
+        metadata["Results"] = "" if fingerprint is None else cached_call(
+            processor["func"], full_transcript, fingerprint, report, model=model
+        )
+
+    metadata["Preprocessing"] = stats
+    metadata["Deduplication"] = report
+    metadata["Processed"] = True
+    return metadata
+
+
+def provide_summary_chunk(chunk, chunk_num, total_chunk_num, model=LARGE_MODEL):
     print(f"Processing chunk {chunk_num} of {total_chunk_num}...")
-    response = chat(
-        model="llama3",
+    response = llm_chat(
+        model=model,
         messages=[
             {
                 "role": "system",
@@ -147,9 +1223,9 @@ def provide_summary_chunk(chunk, chunk_num, total_chunk_num):
     return response["message"]["content"]
 
 
-def provide_summary(full_transcript):
-    response = chat(
-        model="llama3",
+def provide_summary(full_transcript, model=LARGE_MODEL):
+    response = llm_chat(
+        model=model,
         messages=[
             {
                 "role": "system",
@@ -173,10 +1249,10 @@ def provide_summary(full_transcript):
     return response["message"]["content"]
 
 
-def generate_idea(full_transcript):
+def generate_idea(full_transcript, model=LARGE_MODEL):
     print(f"Generating ideas...")
-    response = chat(
-        model="llama3",
+    response = llm_chat(
+        model=model,
         messages=[
             {
                 "role": "system",
@@ -203,10 +1279,10 @@ def generate_idea(full_transcript):
     return response["message"]["content"]
 
 
-def generate_idea_chunk(chunk, chunk_num, total_chunk_num):
+def generate_idea_chunk(chunk, chunk_num, total_chunk_num, model=LARGE_MODEL):
     print(f"Generating ideas for chunk {chunk_num} of {total_chunk_num}...")
-    response = chat(
-        model="llama3",
+    response = llm_chat(
+        model=model,
         messages=[
             {
                 "role": "system",